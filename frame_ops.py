@@ -0,0 +1,170 @@
+"""
+Frame processing helpers shared by the CLI capture script and the web server.
+"""
+import importlib.util
+import os
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    import cffi
+    CFFI_AVAILABLE = True
+except ImportError:
+    CFFI_AVAILABLE = False
+
+# Brightness/contrast implementations accepted by build_adjuster
+ADJUST_BACKENDS = ('lut', 'numba', 'native')
+
+# C kernel for the 'native' backend, compiled once per process. Contrast and
+# brightness are runtime arguments, so one module serves every value. The
+# float32 multiply-add (contracted to FMA where available) and round-half-even
+# conversion mirror OpenCV's own SIMD path for convertScaleAbs.
+NATIVE_ADJUST_CDEF = "void adjust(const uint8_t *src, uint8_t *dst, size_t n, float alpha, float beta);"
+NATIVE_ADJUST_SOURCE = """
+#include <math.h>
+#include <stddef.h>
+#include <stdint.h>
+
+void adjust(const uint8_t *src, uint8_t *dst, size_t n, float alpha, float beta)
+{
+    for (size_t i = 0; i < n; i++) {
+        float v = fabsf((float)src[i] * alpha + beta);
+        v = v > 255.0f ? 255.0f : v;
+        dst[i] = (uint8_t)(int32_t)nearbyintf(v);
+    }
+}
+"""
+NATIVE_MODULE_NAME = '_cctv_adjust_f32'
+# Per-user build directory, so the module loaded is never one another user
+# could have planted (the CLI and server are often run with sudo)
+NATIVE_BUILD_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'cctv'
+_native_module = None
+_native_error = None
+_native_lock = threading.Lock()
+
+
+def build_adjust_lut(alpha, beta):
+    """Build a 256-entry uint8 LUT for a brightness/contrast adjustment.
+
+    Same mapping as cv2.convertScaleAbs: saturate(|alpha * x + beta|),
+    rounded (values landing exactly on .5 may differ by one level).
+    """
+    values = np.abs(alpha * np.arange(256, dtype=np.float64) + beta)
+    return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, boundscheck=False, cache=True)
+    def _adjust_kernel(src, alpha, beta, out):
+        for i in prange(src.size):
+            v = abs(src[i] * alpha + beta)
+            out[i] = 255 if v > 255 else np.uint8(np.rint(v))
+
+
+def native_kernel():
+    """Compile (once) and return the native adjust kernel module.
+    
+    Thread-safe; a failed build is remembered and re-raised rather than
+    retried on every call.
+    """
+    global _native_module, _native_error
+    with _native_lock:
+        if _native_module is None and _native_error is None:
+            try:
+                NATIVE_BUILD_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+                ffi = cffi.FFI()
+                ffi.cdef(NATIVE_ADJUST_CDEF)
+                # -fno-math-errno lets nearbyintf vectorize
+                ffi.set_source(NATIVE_MODULE_NAME, NATIVE_ADJUST_SOURCE,
+                               extra_compile_args=['-O3', '-march=native', '-fno-math-errno'],
+                               libraries=['m'])
+                path = ffi.compile(tmpdir=str(NATIVE_BUILD_DIR))
+                spec = importlib.util.spec_from_file_location(NATIVE_MODULE_NAME, path)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                _native_module = module
+            except Exception as e:
+                _native_error = e
+        if _native_error is not None:
+            raise _native_error
+        return _native_module
+
+
+def native_kernel_ready():
+    """True once native_kernel() can return without compiling"""
+    return _native_module is not None
+
+
+def build_adjuster(alpha, beta, backend='lut', wait=True):
+    """Return a function ``adjust(src, dst=None)`` applying brightness/contrast.
+
+    The 'lut' backend gathers through a precomputed table with cv2.LUT; the
+    'numba' backend runs a multi-threaded JIT kernel over the pixels; the
+    'native' backend runs a C loop compiled on first use. 'numba' and
+    'native' fall back to 'lut' when their toolchain is unavailable, and
+    'native' also while the kernel has not been compiled yet if ``wait`` is
+    false. All follow convertScaleAbs to within one level: the LUT and numba
+    kernels compute in different precision, so values within rounding error
+    of a .5 tie can land on the other side ('native' matches OpenCV's float32
+    arithmetic). All accept any contiguous uint8 image, including
+    single-channel.
+    """
+    if backend == 'native' and CFFI_AVAILABLE and (wait or native_kernel_ready()):
+        try:
+            module = native_kernel()
+        except Exception as e:
+            print(f"WARNING: native adjust kernel unavailable, using LUT: {e}")
+        else:
+            ffi, lib = module.ffi, module.lib
+
+            def adjust(src, dst=None):
+                if dst is None:
+                    dst = np.empty_like(src)
+                lib.adjust(ffi.from_buffer('uint8_t[]', src),
+                           ffi.from_buffer('uint8_t[]', dst, require_writable=True),
+                           src.size, alpha, beta)
+                return dst
+            return adjust
+
+    if backend == 'numba' and NUMBA_AVAILABLE:
+        alpha, beta = np.float32(alpha), np.float32(beta)
+        # Compile now rather than on the first real frame
+        _adjust_kernel(np.zeros(1, np.uint8), alpha, beta, np.empty(1, np.uint8))
+
+        def adjust(src, dst=None):
+            if dst is None:
+                dst = np.empty_like(src)
+            _adjust_kernel(src.reshape(-1), alpha, beta, dst.reshape(-1))
+            return dst
+        return adjust
+
+    lut = build_adjust_lut(alpha, beta)
+
+    def adjust(src, dst=None):
+        return cv2.LUT(src, lut, dst=dst)
+    return adjust
+
+
+def bgr_to_bgr_gray(frame, adjust=None, dst=None, gray=None):
+    """Convert a BGR frame to 3-channel grey.
+
+    Computes luma once and broadcasts it into all three channels, instead of
+    a GRAY2BGR round-trip into a new image. Writes into ``dst`` (default: the
+    input frame, in place); ``gray`` is an optional preallocated single-channel
+    scratch buffer. If an adjuster is given it is applied to the luma channel
+    before the merge.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+    if adjust is not None:
+        gray = adjust(gray, gray)
+    return cv2.merge((gray, gray, gray), dst=frame if dst is None else dst)
+
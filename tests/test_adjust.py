@@ -0,0 +1,75 @@
+"""Brightness/contrast backends compared against cv2.convertScaleAbs.
+
+Run from the repository root with: python -m unittest discover tests
+"""
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+
+import frame_ops
+from frame_ops import ADJUST_BACKENDS, bgr_to_bgr_gray, build_adjuster
+
+# (contrast, brightness offset) pairs, including ones that hit exact .5 ties
+SETTINGS = [(1.0, 0), (0.5, 100), (1.3, -10), (1.37, 14), (2.0, -100), (0.75, 0)]
+
+
+def backend_available(backend):
+    if backend == 'numba':
+        return frame_ops.NUMBA_AVAILABLE
+    if backend == 'native':
+        if not frame_ops.CFFI_AVAILABLE:
+            return False
+        try:
+            frame_ops.native_kernel()
+        except Exception:
+            return False
+    return True
+
+
+class AdjusterTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.frame = rng.integers(0, 256, (72, 128, 3), dtype=np.uint8)
+        # Every input value, so every table entry is exercised
+        self.ramp = np.arange(256, dtype=np.uint8).reshape(16, 16)
+
+    def test_backends_match_convert_scale_abs(self):
+        for backend in ADJUST_BACKENDS:
+            if not backend_available(backend):
+                continue
+            for alpha, beta in SETTINGS:
+                with self.subTest(backend=backend, alpha=alpha, beta=beta):
+                    adjust = build_adjuster(alpha, beta, backend)
+                    for img in (self.frame, self.ramp):
+                        expected = cv2.convertScaleAbs(img, alpha=alpha, beta=beta)
+                        diff = np.abs(adjust(img).astype(int) - expected)
+                        self.assertLessEqual(diff.max(), 1)
+
+    def test_adjust_into_dst(self):
+        for backend in ADJUST_BACKENDS:
+            if not backend_available(backend):
+                continue
+            with self.subTest(backend=backend):
+                dst = np.empty_like(self.frame)
+                self.assertIs(build_adjuster(1.3, -10, backend)(self.frame, dst), dst)
+
+    def test_native_falls_back_to_lut_while_not_compiled(self):
+        with mock.patch.object(frame_ops, 'native_kernel_ready', return_value=False), \
+                mock.patch.object(frame_ops, 'native_kernel') as native_kernel:
+            adjust = build_adjuster(1.3, -10, 'native', wait=False)
+        native_kernel.assert_not_called()
+        expected = build_adjuster(1.3, -10, 'lut')(self.frame)
+        self.assertTrue((adjust(self.frame) == expected).all())
+
+    def test_bgr_to_bgr_gray(self):
+        gray = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
+        out = bgr_to_bgr_gray(self.frame.copy())
+        for channel in range(3):
+            self.assertTrue((out[..., channel] == gray).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
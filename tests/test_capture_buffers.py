@@ -0,0 +1,81 @@
+"""Interleaving tests for the grabber/processor frame buffers.
+
+Run from the repository root with: python -m unittest discover tests
+"""
+import unittest
+
+import numpy as np
+
+from webcam_server import CaptureBuffers
+
+
+def grab(buffers, value):
+    """Start a grab: take the back slot and write a frame into it"""
+    idx, buf = buffers.back()
+    buf[:] = value
+    return idx, buf
+
+
+class CaptureBuffersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buffers = CaptureBuffers(2, 2)
+
+    def assert_distinct(self):
+        bufs = self.buffers.bufs
+        self.assertEqual(len({id(buf) for buf in bufs}), len(bufs))
+
+    def test_acquire_returns_latest_frame(self):
+        self.buffers.publish(*grab(self.buffers, 1))
+        frame = self.buffers.acquire(timeout=0)
+        self.assertTrue((frame == 1).all())
+        self.assertIsNone(self.buffers.acquire(timeout=0))
+
+    def test_grabber_never_writes_the_held_frame(self):
+        self.buffers.publish(*grab(self.buffers, 1))
+        front = self.buffers.acquire(timeout=0)
+
+        # Grabber publishes and starts the next frame while the front is held
+        self.buffers.publish(*grab(self.buffers, 2))
+        idx, back = grab(self.buffers, 3)
+        self.assertIsNot(back, front)
+        self.assertTrue((front == 1).all())
+
+        # The processor takes the ready frame mid-grab: it must get frame 2,
+        # not the buffer the grabber is still writing
+        front = self.buffers.acquire(timeout=0)
+        self.assertIsNot(front, back)
+        self.assertTrue((front == 2).all())
+
+        self.buffers.publish(idx, back)
+        self.assert_distinct()
+        self.assertTrue((self.buffers.acquire(timeout=0) == 3).all())
+
+    def test_back_slot_moves_on_after_publish(self):
+        idx, back = grab(self.buffers, 1)
+        self.buffers.publish(idx, back)
+        next_idx, next_back = self.buffers.back()
+        self.assertNotEqual(next_idx, idx)
+        self.assertIsNot(next_back, back)
+        with self.assertRaises(ValueError):
+            self.buffers.publish(idx, back)  # stale slot, already ready
+
+    def test_unread_frames_are_counted_as_dropped(self):
+        for value in range(1, 4):
+            self.buffers.publish(*grab(self.buffers, value))
+        self.assertEqual(self.buffers.dropped, 2)
+        self.assertTrue((self.buffers.acquire(timeout=0) == 3).all())
+
+    def test_reallocated_frame_replaces_only_its_slot(self):
+        idx, _ = self.buffers.back()
+        resized = np.full((4, 4, 3), 5, np.uint8)
+        self.buffers.publish(idx, resized)
+        self.assert_distinct()
+        self.assertIs(self.buffers.acquire(timeout=0), resized)
+
+        # The new array is kept for that slot rather than reallocated again
+        self.assertIs(self.buffers.bufs[idx], resized)
+
+
+if __name__ == '__main__':
+    unittest.main()
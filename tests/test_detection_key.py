@@ -0,0 +1,53 @@
+"""Tests for the near-duplicate frame check that lets detection be skipped.
+
+Run from the repository root with: python -m unittest discover tests
+"""
+import unittest
+
+import cv2
+import numpy as np
+
+from webcam_server import DETECTION_SIZE, detection_key, same_scene
+
+
+def scene(rng):
+    """A smooth, textured 16:9 frame at detection size"""
+    height = DETECTION_SIZE * 9 // 16
+    coarse = rng.integers(0, 256, (height // 20, DETECTION_SIZE // 20, 3), dtype=np.uint8)
+    return cv2.resize(coarse, (DETECTION_SIZE, height), interpolation=cv2.INTER_CUBIC)
+
+
+def recapture(frame, rng):
+    """The same frame as a webcam would deliver it again: sensor noise plus MJPEG"""
+    noisy = np.clip(frame + rng.normal(0, 4, frame.shape), 0, 255).astype(np.uint8)
+    _, packet = cv2.imencode('.jpg', noisy, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    return cv2.imdecode(packet, cv2.IMREAD_COLOR)
+
+
+class SameSceneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.frame = scene(self.rng)
+        self.key = ('yolo', 0.5, detection_key(self.frame))
+
+    def test_noisy_copy_matches(self):
+        for _ in range(5):
+            copy = recapture(self.frame, self.rng)
+            self.assertFalse((copy == self.frame).all())
+            self.assertTrue(same_scene(('yolo', 0.5, detection_key(copy)), self.key))
+
+    def test_small_object_entering_differs(self):
+        frame = recapture(self.frame, self.rng)
+        frame[100:160, 300:330] = (40, 40, 200)  # ~30x60 px figure
+        self.assertFalse(same_scene(('yolo', 0.5, detection_key(frame)), self.key))
+
+    def test_model_or_confidence_change_differs(self):
+        thumb = self.key[2]
+        self.assertFalse(same_scene(('rfdetr', 0.5, thumb), self.key))
+        self.assertFalse(same_scene(('yolo', 0.6, thumb), self.key))
+        self.assertFalse(same_scene(self.key, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@ import sys
 import os
 import time
 from pathlib import Path
+from frame_ops import ADJUST_BACKENDS, bgr_to_bgr_gray, build_adjuster
 
 def main():
     parser = argparse.ArgumentParser(
@@ -43,6 +44,10 @@ def main():
         "--night", action="store_true",
         help="Enable night mode (high exposure, high gain, black & white)."
     )
+    parser.add_argument(
+        "--adjust-backend", choices=ADJUST_BACKENDS, default="lut",
+        help="Brightness/contrast implementation (numba needs numba, native needs cffi and a C compiler)."
+    )
     
     # Filter out Jupyter kernel arguments before parsing
     args_to_parse = [arg for arg in sys.argv[1:] if not arg.startswith('--f=')]
@@ -91,8 +96,13 @@ def main():
     print(f"Brightness: {args.brightness}, Contrast: {args.contrast}")
     print(f"Saving to: {output_dir.absolute()}\n")
 
+    # Brightness/contrast are fixed for the run, so build the adjuster once
+    # alpha = contrast, beta = brightness offset
+    adjust = build_adjuster(args.contrast, args.brightness * 2, args.adjust_backend)
+
     frame_count = 0
     failed_count = 0
+    adjusted = None  # output buffer, reused after the first frame
     while frame_count < args.num_frames and failed_count < 3:
         ret, frame = cap.read()
         if not ret:
@@ -103,14 +113,11 @@ def main():
 
         failed_count = 0  # Reset on successful read
         
-        # Convert to grayscale in night mode
+        # Apply brightness/contrast adjustment, converting to grayscale in night mode
         if args.night:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)  # Convert back to 3-channel for consistency
-        
-        # Apply brightness/contrast adjustment
-        # alpha = contrast, beta = brightness offset
-        adjusted = cv2.convertScaleAbs(frame, alpha=args.contrast, beta=args.brightness * 2)
+            adjusted = bgr_to_bgr_gray(frame, adjust)  # Keep 3-channel for consistency
+        else:
+            adjusted = adjust(frame, adjusted)
 
         # Save frame
         output_file = output_dir / f"frame_{frame_count:04d}.jpg"
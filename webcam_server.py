@@ -4,11 +4,18 @@ Web-based camera streaming server with live controls and object detection.
 Access at http://localhost:5000
 """
 import cv2
+import importlib.util
+import math
+import os
+import sys
 import threading
 import time
+from collections import deque
 from flask import Flask, render_template, jsonify, request
 from pathlib import Path
+from werkzeug.wsgi import ClosingIterator
 import numpy as np
+from frame_ops import ADJUST_BACKENDS, bgr_to_bgr_gray, build_adjuster, native_kernel
 
 # Import models
 try:
@@ -26,6 +33,52 @@ except ImportError:
     RFDETR_AVAILABLE = False
     print("WARNING: transformers/torch not installed. Install with: pip install transformers torch")
 
+try:
+    import torch
+    TORCH_AVAILABLE = True
+except ImportError:
+    TORCH_AVAILABLE = False
+
+# Set by load_models. CUDA is probed there rather than at import, so under
+# gunicorn it is first touched in the forked worker, not the master.
+CUDA_AVAILABLE = False
+# Run detection in FP16 on CUDA (tensor cores, half the memory traffic)
+HALF_PRECISION = False
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    turbo_jpeg = TurboJPEG()
+    TURBOJPEG_AVAILABLE = True
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+    TURBOJPEG_AVAILABLE = False
+    print("WARNING: PyTurboJPEG/libjpeg-turbo not available, using cv2.imencode. Install with: pip install PyTurboJPEG")
+
+try:
+    from gunicorn.app.base import BaseApplication
+    GUNICORN_AVAILABLE = True
+except ImportError:
+    GUNICORN_AVAILABLE = False
+    print("WARNING: gunicorn not installed, using the Flask development server. Install with: pip install gunicorn")
+
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = 5000
+# Each stream viewer holds a server thread for as long as it is connected, so
+# the pool is sized for MAX_VIEWERS streams plus headroom for the control and
+# state API; /video_feed turns viewers beyond the limit away with a 503
+MAX_VIEWERS = int(os.environ.get('CCTV_MAX_VIEWERS', 12))
+CONTROL_THREADS = 4
+SERVER_THREADS = MAX_VIEWERS + CONTROL_THREADS
+
+JPEG_QUALITY = 80
+
+# Brightness/contrast implementation: 'lut' (cv2.LUT), 'numba' or 'native'
+ADJUST_BACKEND = os.environ.get('CCTV_ADJUST_BACKEND', 'lut')
+if ADJUST_BACKEND not in ADJUST_BACKENDS:
+    print(f"WARNING: unknown CCTV_ADJUST_BACKEND {ADJUST_BACKEND!r}, using 'lut'. "
+          f"Choose from: {', '.join(ADJUST_BACKENDS)}")
+    ADJUST_BACKEND = 'lut'
+
 app = Flask(__name__)
 
 # Global camera state
@@ -33,49 +86,385 @@ camera_state = {
     'brightness': 0,
     'contrast': 1.0,
     'night_mode': False,
-    'frame': None,
+    'adjust': build_adjuster(1.0, 0, ADJUST_BACKEND, wait=False),
     'lock': threading.Lock(),
     'running': True,
+    'capturing': False,  # camera opened and the capture loop running
     'fps': 0,
     'frame_count': 0,
+    'fps_time': time.time(),
     'detection_model': 'none',  # 'none', 'yolo', 'rfdetr'
     'detection_confidence': 0.5,
     'detections': [],
+    'detections_key': None,  # detection_key of the frame 'detections' came from
+    'detection_dropped': 0,
+    'next_frame_idx': {},  # output dir -> next capture number
+    'viewers': 0,  # open /video_feed streams
 }
 
+# Latest encoded frame, as (JPEG bytes, multipart part wrapping them). The
+# producer fills the inactive slot, then bumps frame_seq (a single atomic
+# store under the GIL), so one-off readers can index the slot without a lock.
+# Stream viewers block on frame_cv, which is notified once per published
+# frame, instead of polling, and all write out the same prebuilt part.
+frame_slots = [None, None]
+frame_seq = 0
+frame_cv = threading.Condition()
+
+# Batched detection: the capture thread queues frames and a worker pulls up to
+# DETECTION_BATCH_SIZE of them per forward pass (little gain beyond 16)
+DETECTION_BATCH_SIZE = 8
+detection_queue = deque(maxlen=DETECTION_BATCH_SIZE)
+detection_cv = threading.Condition()
+
+# Adjusted-frame buffers cycle between the capture thread, the detection
+# queue and publishing, so steady-state streaming allocates nothing per frame
+# (deque append/pop are thread-safe)
+frame_pool = deque()
+
+# Requested capture resolution
+FRAME_WIDTH = 1280
+FRAME_HEIGHT = 720
+
+class CaptureBuffers:
+    """Frame buffers shared by the camera grabber thread and the processing loop.
+
+    Three preallocated buffers rotate between three roles: the back buffer
+    the grabber is writing, the ready buffer holding the newest complete
+    frame, and the front buffer the processor is reading. publish() swaps
+    back and ready, acquire() swaps ready and front, each under a lock held
+    only for the swap. The roles are always a permutation of the three, so
+    the grabber never writes a buffer the processor holds or is about to
+    take, and neither side waits on the other's work.
+    ``dropped`` counts ready frames replaced before the processor took them.
+    """
+
+    def __init__(self, height, width):
+        self.bufs = [np.empty((height, width, 3), np.uint8) for _ in range(3)]
+        self.back_idx, self.ready_idx, self.front_idx = 0, 1, 2
+        self.dropped = 0
+        self.new = threading.Event()
+        self.lock = threading.Lock()
+
+    def back(self):
+        """Slot the grabber should write the next frame into, as (idx, buffer)"""
+        with self.lock:
+            return self.back_idx, self.bufs[self.back_idx]
+
+    def publish(self, idx, frame):
+        """Make the frame grabbed into slot ``idx`` (from back()) the ready one.
+        
+        ``frame`` is normally the slot's own buffer. A decoder that had to
+        reallocate (the camera changed resolution) returns a new array, which
+        then replaces that slot's buffer and is reused from there on.
+        """
+        with self.lock:
+            if idx != self.back_idx:
+                raise ValueError(f"slot {idx} is not the back buffer")
+            self.bufs[idx] = frame
+            if self.new.is_set():
+                self.dropped += 1  # the ready frame was never taken
+            self.back_idx, self.ready_idx = self.ready_idx, idx
+            self.new.set()
+
+    def acquire(self, timeout=None):
+        """Wait for a new frame and take it, returning the buffer (or None).
+        
+        The buffer stays untouched by the grabber until the next acquire().
+        """
+        if not self.new.wait(timeout):
+            return None
+        with self.lock:
+            self.new.clear()
+            self.front_idx, self.ready_idx = self.ready_idx, self.front_idx
+            return self.bufs[self.front_idx]
+
+capture_buffers = CaptureBuffers(FRAME_HEIGHT, FRAME_WIDTH)
+
+# Long side of the frames fed to the detectors (YOLOv8 native input size)
+DETECTION_SIZE = 640
+
+# A frame reuses the last detected frame's detections unless more than
+# SCENE_CHANGED_VALUES of their thumbnail values differ by over
+# SCENE_PIXEL_DELTA levels. Each thumbnail pixel averages ~100 frame pixels,
+# so sensor noise and MJPEG artifacts stay far below the delta, while a
+# small object entering the scene still exceeds the count.
+SCENE_PIXEL_DELTA = 12
+SCENE_CHANGED_VALUES = 6
+
+# YOLO input after letterboxing a DETECTION_SIZE frame to stride 32, e.g.
+# (384, 640) for 16:9; fixed so a TensorRT engine can be built for it
+_detection_scale = DETECTION_SIZE / max(FRAME_WIDTH, FRAME_HEIGHT)
+YOLO_IMGSZ = tuple(math.ceil(round(d * _detection_scale) / 32) * 32
+                   for d in (FRAME_HEIGHT, FRAME_WIDTH))
+YOLO_WEIGHTS = 'yolov8n.pt'  # nano model
+
 # Load models
 yolo_model = None
 rfdetr_model = None
 rfdetr_processor = None
 
+# RF-DETR host-to-device staging (pinned buffer + dedicated copy stream)
+rfdetr_staging = None
+rfdetr_copy_stream = None
+rfdetr_copy_done = None
+rfdetr_norm = None  # per-channel (scale, offset) mapping uint8 to pixel_values
+
 def load_models():
     """Load detection models on startup"""
     global yolo_model, rfdetr_model, rfdetr_processor, RFDETR_AVAILABLE
+    global CUDA_AVAILABLE, HALF_PRECISION
+    
+    CUDA_AVAILABLE = TORCH_AVAILABLE and torch.cuda.is_available()
+    HALF_PRECISION = CUDA_AVAILABLE
     
     if YOLO_AVAILABLE:
         print("Loading YOLO model...")
         try:
-            yolo_model = YOLO('yolov8n.pt')  # nano model
+            engine_path = yolo_engine_path()
+            if engine_path is not None and engine_path.exists():
+                yolo_model = load_yolo_engine(engine_path)
+            if yolo_model is None:
+                yolo_model = YOLO(YOLO_WEIGHTS)
             print("✓ YOLO loaded")
         except Exception as e:
             print(f"✗ Failed to load YOLO: {e}")
+        else:
+            if engine_path is not None and not engine_path.exists():
+                threading.Thread(target=build_yolo_engine, args=(engine_path,),
+                                 daemon=True).start()
     
-    # RF-DETR is optional - skip for now
+    # RF-DETR is optional - skip for now. When it is loaded, move it to the
+    # GPU in FP16 (`.cuda().half()` after `.eval()` when HALF_PRECISION is
+    # set); upload_rfdetr_frames casts its inputs to the model's dtype.
     RFDETR_AVAILABLE = False
 
+def yolo_engine_path():
+    """Cache path of the YOLO TensorRT engine, or None without CUDA/TensorRT.
+    
+    The engine is specialized ahead of time for the input shape, batch range
+    and precision (conv+BN+SiLU fused, tactics picked per shape), so it is
+    cached under a name encoding all three.
+    """
+    if not CUDA_AVAILABLE or importlib.util.find_spec('tensorrt') is None:
+        return None
+    height, width = YOLO_IMGSZ
+    precision = 'fp16' if HALF_PRECISION else 'fp32'
+    return Path(YOLO_WEIGHTS).with_name(
+        f"{Path(YOLO_WEIGHTS).stem}_{width}x{height}_b1-{DETECTION_BATCH_SIZE}_{precision}.engine"
+    )
+
+def load_yolo_engine(engine_path):
+    """Load a cached YOLO TensorRT engine, returning None if it fails"""
+    try:
+        return YOLO(str(engine_path), task='detect')
+    except Exception as e:
+        print(f"✗ TensorRT engine unavailable, using {YOLO_WEIGHTS}: {e}")
+        return None
+
+def build_yolo_engine(engine_path):
+    """Export the YOLO TensorRT engine, then swap it in for the .pt model.
+    
+    Runs in a background thread: the export takes minutes, far longer than
+    gunicorn's worker timeout, so it must not hold up worker startup. The
+    .pt model serves detections until the engine is ready.
+    """
+    global yolo_model
+    
+    print(f"Building TensorRT engine {engine_path} in the background (one-off, takes a few minutes)...")
+    try:
+        # Dynamic batch profile capped at DETECTION_BATCH_SIZE, so a batch of
+        # one changed frame costs a batch-1 inference, not a padded full batch
+        exported = YOLO(YOLO_WEIGHTS).export(
+            format='engine', imgsz=YOLO_IMGSZ, half=HALF_PRECISION,
+            batch=DETECTION_BATCH_SIZE, dynamic=True, workspace=4, device=0,
+        )
+        Path(exported).rename(engine_path)
+    except Exception as e:
+        print(f"✗ TensorRT engine build failed, staying on {YOLO_WEIGHTS}: {e}")
+        return
+    
+    model = load_yolo_engine(engine_path)
+    if model is None:
+        return
+    
+    # Warm up before the swap, so the live stream never waits on it
+    small, _ = detection_input(np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8))
+    try:
+        for batch in (1, DETECTION_BATCH_SIZE):
+            model([small] * batch, imgsz=YOLO_IMGSZ, half=HALF_PRECISION, verbose=False)
+    except Exception as e:
+        print(f"✗ TensorRT engine warm-up failed, staying on {YOLO_WEIGHTS}: {e}")
+        return
+    yolo_model = model
+    print("✓ YOLO switched to the TensorRT engine")
+
+def upload_rfdetr_frames(small_frames, device, dtype):
+    """Send a batch of uint8 frames to the model device and normalize them there.
+    
+    Returns RF-DETR's [B, 3, H, W] pixel_values in the model's dtype. The
+    frames cross PCIe as uint8 (a quarter of the float32 bytes), through a
+    pinned staging buffer on a dedicated copy stream, so the upload of one
+    batch can overlap the previous batch's forward pass.
+    """
+    global rfdetr_staging, rfdetr_copy_stream, rfdetr_copy_done, rfdetr_norm
+    
+    shape = (len(small_frames),) + small_frames[0].shape
+    if device.type != 'cuda':
+        frames = torch.from_numpy(np.stack(small_frames)).to(device)
+    else:
+        # Page-locked staging lets the copy run as DMA on its own stream; the
+        # buffer is only reallocated when the batch shape changes
+        if rfdetr_staging is None or tuple(rfdetr_staging.shape) != shape:
+            rfdetr_staging = torch.empty(shape, dtype=torch.uint8, pin_memory=True)
+        if rfdetr_copy_stream is None:
+            rfdetr_copy_stream = torch.cuda.Stream(device=device)
+        
+        # Don't overwrite the staging buffer while the previous copy is in flight
+        if rfdetr_copy_done is not None:
+            rfdetr_copy_done.synchronize()
+        
+        np.stack(small_frames, out=rfdetr_staging.numpy())
+        with torch.cuda.stream(rfdetr_copy_stream):
+            frames = rfdetr_staging.to(device, non_blocking=True)
+            rfdetr_copy_done = torch.cuda.Event()
+            rfdetr_copy_done.record(rfdetr_copy_stream)
+        
+        # Compute stream waits on the copy without blocking the host
+        torch.cuda.current_stream(device).wait_event(rfdetr_copy_done)
+        frames.record_stream(torch.cuda.current_stream(device))
+    
+    # The processor's rescale + normalize, folded into one multiply-add
+    if rfdetr_norm is None or rfdetr_norm[0].device != device:
+        mean = torch.tensor(rfdetr_processor.image_mean, device=device)
+        std = torch.tensor(rfdetr_processor.image_std, device=device)
+        rfdetr_norm = ((rfdetr_processor.rescale_factor / std)[:, None, None],
+                       (-mean / std)[:, None, None])
+    scale, offset = rfdetr_norm
+    pixel_values = frames.permute(0, 3, 1, 2).float() * scale + offset
+    return pixel_values.to(dtype)
+
+def update_adjuster():
+    """Rebuild the brightness/contrast adjuster (call with camera_state['lock'] held).
+    
+    Never compiles: until prepare_native_adjuster has built the native
+    kernel, the LUT backend stands in for it.
+    """
+    if camera_state['night_mode']:
+        brightness, contrast = -5, 1.3
+    else:
+        brightness, contrast = camera_state['brightness'], camera_state['contrast']
+    camera_state['adjust'] = build_adjuster(contrast, brightness * 2, ADJUST_BACKEND,
+                                            wait=False)
+
+def prepare_native_adjuster():
+    """Compile the native adjust kernel off the request path, then swap it in"""
+    try:
+        native_kernel()
+    except Exception as e:
+        print(f"WARNING: native adjust kernel unavailable, using LUT: {e}")
+        return
+    with camera_state['lock']:
+        update_adjuster()
+
+def acquire_frame_buffer(like):
+    """Take a recycled frame buffer shaped like ``like``, allocating if none is free"""
+    try:
+        buf = frame_pool.pop()
+    except IndexError:
+        return np.empty_like(like)
+    if buf.shape != like.shape:
+        return np.empty_like(like)
+    return buf
+
+def release_frame_buffer(buf):
+    """Return a frame buffer to the pool once nothing references it"""
+    frame_pool.append(buf)
+
+def open_camera(index):
+    """Open a camera, using the V4L2 backend directly on Linux"""
+    if sys.platform.startswith('linux'):
+        cap = cv2.VideoCapture(index, cv2.CAP_V4L2)
+        if cap.isOpened():
+            return cap
+    return cv2.VideoCapture(index)
+
+def decode_mjpeg(packet, frame):
+    """Decode a raw MJPEG packet into ``frame``, reallocating only on a size change"""
+    width, height, _, _ = turbo_jpeg.decode_header(packet)
+    if frame is None or frame.shape != (height, width, 3):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+    return turbo_jpeg.decode(packet, pixel_format=TJPF_BGR, dst=frame)
+
+def apply_exposure(cap, night_mode):
+    """Set the sensor exposure/gain for night or day mode"""
+    if night_mode:
+        cap.set(cv2.CAP_PROP_EXPOSURE, -8)
+        cap.set(cv2.CAP_PROP_GAIN, 40)
+        cap.set(cv2.CAP_PROP_BRIGHTNESS, 20)
+    else:
+        cap.set(cv2.CAP_PROP_EXPOSURE, -1)
+        cap.set(cv2.CAP_PROP_GAIN, 0)
+
+def grab_frames(cap, buffers, raw_mjpeg):
+    """Camera grabber thread: keep pulling frames into the back buffer.
+
+    Grabbing continuously keeps the driver queue drained, so the processing
+    loop always gets the newest frame. This is the only thread touching
+    ``cap`` once streaming starts.
+    """
+    night_mode = None
+    while camera_state['running']:
+        if camera_state['night_mode'] != night_mode:
+            night_mode = camera_state['night_mode']
+            apply_exposure(cap, night_mode)
+        
+        if not cap.grab():
+            continue
+        idx, back = buffers.back()
+        if raw_mjpeg:
+            ret, data = cap.retrieve()
+            if ret and data.ndim == 3:
+                # Not an MJPEG packet: either the backend decoded the frame
+                # itself, or it hands out raw pixels (e.g. YUYV as H x W x 2).
+                # Let OpenCV convert from now on.
+                raw_mjpeg = False
+                cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+                if data.shape[2] == 3:
+                    frame = data
+                else:
+                    ret = False
+            elif ret:
+                try:
+                    frame = decode_mjpeg(data, back)
+                except OSError:
+                    ret = False  # truncated or corrupt packet, skip it
+        else:
+            ret, frame = cap.retrieve(back)
+        if ret:
+            buffers.publish(idx, frame)
+
 def capture_frames():
     """Background thread for camera capture"""
-    cap = cv2.VideoCapture(0)
+    cap = open_camera(0)
     if not cap.isOpened():
         print("ERROR: Could not open camera")
         return
+    camera_state['capturing'] = True
     
     # Camera settings
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
     cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
     cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
     
+    # With libjpeg-turbo available, take the camera's MJPEG packets as-is and
+    # decode them straight into our own frame buffer, skipping OpenCV's
+    # decode into a fresh Mat and the copy out of it. Only when the camera
+    # actually agreed to MJPEG: for other formats V4L2 would hand out raw pixels.
+    mjpeg = int(cap.get(cv2.CAP_PROP_FOURCC)) == cv2.VideoWriter_fourcc(*'MJPG')
+    raw_mjpeg = TURBOJPEG_AVAILABLE and mjpeg and cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    
     # Warm up camera
     print("Warming up camera...")
     time.sleep(2)
@@ -83,130 +472,322 @@ def capture_frames():
         cap.read()
         time.sleep(0.2)
     
+    grabber = threading.Thread(target=grab_frames, args=(cap, capture_buffers, raw_mjpeg),
+                               daemon=True)
+    grabber.start()
     print("Camera ready! Streaming...")
     
-    last_time = time.time()
+    # Night-mode luma is computed into the same scratch buffer every
+    # iteration; adjusted frames come from the recycled pool
+    gray = None
     
     while camera_state['running']:
-        ret, frame = cap.read()
-        if not ret:
+        frame = capture_buffers.acquire(timeout=1.0)
+        if frame is None:
             continue
         
-        # Apply night mode if enabled
+        # Apply brightness/contrast (prebuilt adjuster) and night mode if enabled,
+        # from the front buffer into a pooled frame
+        adjust = camera_state['adjust']
+        adjusted = acquire_frame_buffer(frame)
         if camera_state['night_mode']:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-            cap.set(cv2.CAP_PROP_EXPOSURE, -8)
-            cap.set(cv2.CAP_PROP_GAIN, 40)
-            cap.set(cv2.CAP_PROP_BRIGHTNESS, 20)
-            brightness = -5
-            contrast = 1.3
+            if gray is None or gray.shape != frame.shape[:2]:
+                gray = np.empty(frame.shape[:2], dtype=np.uint8)
+            bgr_to_bgr_gray(frame, adjust, dst=adjusted, gray=gray)
         else:
-            cap.set(cv2.CAP_PROP_EXPOSURE, -1)
-            cap.set(cv2.CAP_PROP_GAIN, 0)
-            brightness = camera_state['brightness']
-            contrast = camera_state['contrast']
-        
-        # Apply brightness/contrast
-        adjusted = cv2.convertScaleAbs(frame, alpha=contrast, beta=brightness * 2)
+            adjust(frame, adjusted)
         
-        # Run object detection
+        # Hand off to the detection worker, or publish directly
         if camera_state['detection_model'] != 'none':
-            adjusted = run_detection(adjusted)
-        
-        # Convert to JPEG
-        ret, buffer = cv2.imencode('.jpg', adjusted, [cv2.IMWRITE_JPEG_QUALITY, 80])
-        frame_bytes = buffer.tobytes()
-        
-        with camera_state['lock']:
-            camera_state['frame'] = frame_bytes
-            camera_state['frame_count'] += 1
-            
-            # Calculate FPS
-            current_time = time.time()
-            if current_time - last_time >= 1.0:
-                camera_state['fps'] = camera_state['frame_count']
-                camera_state['frame_count'] = 0
-                last_time = current_time
+            with detection_cv:
+                if len(detection_queue) == detection_queue.maxlen:
+                    camera_state['detection_dropped'] += 1
+                    release_frame_buffer(detection_queue.popleft())
+                detection_queue.append(adjusted)
+                detection_cv.notify()
+        else:
+            publish_frame(adjusted)
+            release_frame_buffer(adjusted)
     
+    camera_state['capturing'] = False
+    grabber.join()
     cap.release()
     print("Camera closed")
 
-def run_detection(frame):
-    """Run object detection on frame"""
-    model = camera_state['detection_model']
-    conf_threshold = camera_state['detection_confidence']
+def encode_jpeg(frame):
+    """Encode a BGR frame to JPEG bytes, preferring libjpeg-turbo's SIMD encoder"""
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(frame, quality=JPEG_QUALITY, pixel_format=TJPF_BGR)
+    ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buffer.tobytes()
+
+def latest_frame():
+    """Return the most recently published JPEG bytes (or None), lock-free"""
+    slot = frame_slots[frame_seq & 1]
+    return slot[0] if slot else None
+
+def multipart_part(jpeg):
+    """Wrap JPEG bytes as one part of the MJPEG multipart stream"""
+    return (b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+            % len(jpeg) + jpeg + b'\r\n')
+
+def publish_frame(frame):
+    """Encode a processed frame and make it available to viewers"""
+    global frame_seq
+    frame_bytes = encode_jpeg(frame)
+    # Built once here rather than per viewer in generate_frames
+    slot = (frame_bytes, multipart_part(frame_bytes))
     
-    if model == 'yolo' and yolo_model:
+    # Both the capture thread and the detection worker publish, so producers
+    # serialize on the condition's lock, then wake every waiting viewer
+    with frame_cv:
+        frame_slots[(frame_seq + 1) & 1] = slot
+        frame_seq += 1
+        frame_cv.notify_all()
+        camera_state['frame_count'] += 1
+        
+        # Calculate FPS
+        current_time = time.time()
+        if current_time - camera_state['fps_time'] >= 1.0:
+            camera_state['fps'] = camera_state['frame_count']
+            camera_state['frame_count'] = 0
+            camera_state['fps_time'] = current_time
+
+def publish_frames(frames):
+    """Publish annotated frames in order and recycle their buffers"""
+    for frame in frames:
+        publish_frame(frame)
+        release_frame_buffer(frame)
+
+def overlap_detection():
+    """True when a batch can stay in flight while the next one is submitted"""
+    return CUDA_AVAILABLE and camera_state['detection_model'] == 'rfdetr'
+
+def detection_worker():
+    """Background thread running batched object detection"""
+    pending = None  # finish function of the batch still running on the GPU
+    while camera_state['running']:
+        with detection_cv:
+            # Don't sit waiting for frames while a batch is left to collect
+            if pending is None:
+                detection_cv.wait_for(
+                    lambda: detection_queue or not camera_state['running'], timeout=0.5
+                )
+            frames = list(detection_queue)
+            detection_queue.clear()
+        
+        finish = start_detection(frames) if frames else None
+        
+        # Collect the previous batch only after submitting this one, so this
+        # batch's upload overlaps the previous forward pass
+        if pending is not None:
+            publish_frames(pending())
+            pending = None
+        if finish is not None:
+            if overlap_detection():
+                pending = finish
+            else:
+                publish_frames(finish())
+
+def detection_input(frame):
+    """Downscale a frame to the detectors' native input size.
+    
+    Returns the small frame and the scale factor applied, so boxes can be
+    mapped back onto the full-resolution frame.
+    """
+    h, w = frame.shape[:2]
+    scale = DETECTION_SIZE / max(h, w)
+    if scale >= 1.0:
+        return frame, 1.0
+    size = (round(w * scale), round(h * scale))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR), scale
+
+def draw_detections(frame, detections):
+    """Draw detection boxes and labels onto a frame in place"""
+    for det in detections:
+        x1, y1, x2, y2 = (int(v) for v in det['bbox'])
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        label = f"{det['conf']:.2f}"
+        if det.get('class'):
+            label = f"{det['class']} {label}"
+        cv2.putText(frame, label, (x1, y1 - 10),
+                  cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+    return frame
+
+def detect_yolo(small_frames, scales, conf_threshold):
+    """Run YOLO on a batch of detection-size frames.
+    
+    Returns a function returning the full-frame boxes; YOLO runs
+    synchronously, so the results are ready by then.
+    """
+    # Ultralytics runs a list of frames as one batched forward pass. Take one
+    # reference, since the TensorRT engine build can swap yolo_model mid-call.
+    model = yolo_model
+    results = model(list(small_frames), conf=conf_threshold, imgsz=YOLO_IMGSZ,
+                    half=HALF_PRECISION, verbose=False)
+    
+    batch_detections = []
+    for result, scale in zip(results, scales):
+        batch_detections.append([{
+            'class': model.names[int(box.cls[0])],
+            'conf': float(box.conf[0]),
+            'bbox': (box.xyxy[0] / scale).tolist()
+        } for box in result.boxes])
+    return lambda: batch_detections
+
+def detect_rfdetr(small_frames, scales, conf_threshold):
+    """Queue RF-DETR on a batch of detection-size frames.
+    
+    Returns a function that waits for the model and returns full-frame boxes.
+    On CUDA the forward pass is only enqueued here, so the caller can upload
+    the next batch before collecting this one.
+    """
+    # Frames are already at input size, so the processor's own resize is
+    # skipped and its normalization happens on the device
+    param = next(rfdetr_model.parameters())
+    pixel_values = upload_rfdetr_frames(small_frames, param.device, param.dtype)
+    
+    # Run inference
+    with torch.no_grad():
+        outputs = rfdetr_model(pixel_values=pixel_values)
+    
+    def collect():
+        # Post-process (target sizes are (height, width)); this syncs on the outputs
+        target_sizes = torch.tensor([small.shape[:2] for small in small_frames])
+        results = rfdetr_processor.post_process_object_detection(
+            outputs, target_sizes=target_sizes, threshold=conf_threshold
+        )
+        
+        id2label = rfdetr_model.config.id2label
+        batch_detections = []
+        for result, scale in zip(results, scales):
+            batch_detections.append([{
+                'class': id2label.get(int(label)),
+                'conf': float(score),
+                'bbox': (box / scale).tolist()
+            } for box, score, label in zip(result['boxes'], result['scores'], result['labels'])
+              if score.item() > conf_threshold])
+        return batch_detections
+    return collect
+
+def loaded_detectors():
+    """Map model names to (display name, detect function) for loaded models"""
+    detectors = {}
+    if yolo_model:
+        detectors['yolo'] = ('YOLO', detect_yolo)
+    if rfdetr_model and rfdetr_processor:
+        detectors['rfdetr'] = ('RF-DETR', detect_rfdetr)
+    return detectors
+
+def warm_up_models():
+    """Push blank batches through each loaded model before streaming starts.
+    
+    The first forward pass pays for CUDA context setup and cuDNN algorithm
+    selection; doing it here keeps that stall off the live stream.
+    """
+    blank = np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+    small, scale = detection_input(blank)
+    for name, detect in loaded_detectors().values():
+        print(f"Warming up {name}...")
         try:
-            results = yolo_model(frame, conf=conf_threshold, verbose=False)
-            frame = results[0].plot()
-            
-            # Store detections
-            if results[0].boxes:
-                detections = []
-                for box in results[0].boxes:
-                    detections.append({
-                        'class': yolo_model.names[int(box.cls[0])],
-                        'conf': float(box.conf[0]),
-                        'bbox': box.xyxy[0].tolist()
-                    })
-                camera_state['detections'] = detections
+            for batch in (1, DETECTION_BATCH_SIZE):
+                detect([small] * batch, [scale] * batch, camera_state['detection_confidence'])()
         except Exception as e:
-            print(f"YOLO error: {e}")
+            print(f"✗ {name} warm-up failed: {e}")
+
+def detection_key(small_frame):
+    """Cheap fingerprint of a frame (a 64x36 thumbnail), compared with same_scene"""
+    return cv2.resize(small_frame, (64, 36), interpolation=cv2.INTER_AREA)
+
+def same_scene(key, ref):
+    """True if two (model, confidence, detection_key) keys are near-identical.
+    
+    Sensor noise and MJPEG artifacts change some thumbnail pixels on every
+    frame, so the thumbnails are compared with a tolerance, not for equality.
+    """
+    if ref is None or key[:2] != ref[:2] or key[2].shape != ref[2].shape:
+        return False
+    changed = np.count_nonzero(cv2.absdiff(key[2], ref[2]) > SCENE_PIXEL_DELTA)
+    return changed <= SCENE_CHANGED_VALUES
+
+def start_detection(frames):
+    """Submit a batch of frames for object detection.
+    
+    Returns a function that waits for the results and returns the annotated
+    frames, so the caller can submit the next batch in between.
+    """
+    model = camera_state['detection_model']
+    conf_threshold = camera_state['detection_confidence']
+    
+    detector = loaded_detectors().get(model)
+    if detector is None:
+        return lambda: frames
+    name, detect = detector
+    
+    # Detect on downscaled copies; draw on the full-resolution frames
+    small_frames, scales = zip(*(detection_input(frame) for frame in frames))
+    
+    # Webcams repeat near-identical frames on static scenes; only frames that
+    # differ from the last detected one go through the model, the rest reuse
+    # its detections. Comparing against the last detected frame rather than
+    # the previous one means slow drift still triggers a detection. The key
+    # is stored now, so the next batch compares against this one even while
+    # it is still in flight.
+    ref = camera_state['detections_key']
+    changed = []
+    for i, small in enumerate(small_frames):
+        key = (model, conf_threshold, detection_key(small))
+        if not same_scene(key, ref):
+            changed.append(i)
+            ref = key
+    camera_state['detections_key'] = ref
     
-    elif model == 'rfdetr' and rfdetr_model and rfdetr_processor:
+    collect = None
+    if changed:
         try:
-            # Prepare image
-            inputs = rfdetr_processor(images=frame, return_tensors="pt")
-            device = next(rfdetr_model.parameters()).device
-            inputs = {k: v.to(device) for k, v in inputs.items()}
-            
-            # Run inference
-            with torch.no_grad():
-                outputs = rfdetr_model(**inputs)
-            
-            # Post-process
-            target_sizes = torch.tensor([frame.shape[:2][::-1]])
-            results = rfdetr_processor.post_process_object_detection(
-                outputs, target_sizes=target_sizes, threshold=conf_threshold
-            )
-            
-            # Draw boxes
-            detections = []
-            for boxes, scores, labels in zip(results[0]['boxes'], results[0]['scores'], results[0]['labels']):
-                if scores.item() > conf_threshold:
-                    box = boxes.cpu().numpy().astype(int)
-                    x1, y1, x2, y2 = box
-                    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                    label = f"{scores.item():.2f}"
-                    cv2.putText(frame, label, (x1, y1 - 10),
-                              cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-                    
-                    detections.append({
-                        'conf': float(scores.item()),
-                        'bbox': box.tolist()
-                    })
-            
-            camera_state['detections'] = detections
+            collect = detect([small_frames[i] for i in changed],
+                             [scales[i] for i in changed], conf_threshold)
         except Exception as e:
-            print(f"RF-DETR error: {e}")
+            print(f"{name} error: {e}")
+            camera_state['detections_key'] = None
+            return lambda: frames
     
-    return frame
+    def finish():
+        fresh = {}
+        if collect is not None:
+            try:
+                fresh = dict(zip(changed, collect()))
+            except Exception as e:
+                print(f"{name} error: {e}")
+                camera_state['detections_key'] = None
+                return frames
+        
+        # Draw boxes and store detections from the most recent frame
+        detections = camera_state['detections']
+        for i, frame in enumerate(frames):
+            detections = fresh.get(i, detections)
+            draw_detections(frame, detections)
+        camera_state['detections'] = detections
+        return frames
+    return finish
 
 def generate_frames():
     """Generator for streaming frames"""
+    last_seq = 0
+    part = None
     while camera_state['running']:
-        with camera_state['lock']:
-            frame = camera_state['frame']
+        with frame_cv:
+            # Time out periodically so the generator notices shutdown
+            if frame_cv.wait_for(lambda: frame_seq != last_seq, timeout=1.0):
+                last_seq = frame_seq
+                part = frame_slots[last_seq & 1][1]
+            elif part is None:
+                continue
         
-        if frame is not None:
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n'
-                   b'Content-Length: ' + str(len(frame)).encode() + b'\r\n\r\n'
-                   + frame + b'\r\n')
-        else:
-            time.sleep(0.01)
+        # Every viewer sends the same immutable part, no per-viewer copy. With
+        # no new frame the last one is re-sent as a keepalive: a disconnected
+        # viewer is only noticed on a write, and would hold its slot otherwise.
+        yield part
 
 @app.route('/')
 def index():
@@ -216,11 +797,26 @@ def index():
 @app.route('/video_feed')
 def video_feed():
     """Stream video frames"""
+    with camera_state['lock']:
+        if not camera_state['capturing']:
+            return jsonify({'success': False, 'error': 'Camera not available'}), 503
+        if camera_state['viewers'] >= MAX_VIEWERS:
+            return jsonify({'success': False, 'error': 'Too many viewers'}), 503
+        camera_state['viewers'] += 1
+    
+    # The server closes the iterable when the connection ends, started or
+    # not (direct_passthrough skips the response's own on-close callbacks)
     return app.response_class(
-        generate_frames(),
-        mimetype='multipart/x-mixed-replace; boundary=frame'
+        ClosingIterator(generate_frames(), release_viewer),
+        mimetype='multipart/x-mixed-replace; boundary=frame',
+        direct_passthrough=True
     )
 
+def release_viewer():
+    """Free a viewer slot once its stream connection closes"""
+    with camera_state['lock']:
+        camera_state['viewers'] -= 1
+
 @app.route('/api/state', methods=['GET'])
 def get_state():
     """Get current camera state"""
@@ -233,6 +829,12 @@ def get_state():
             'detection_model': camera_state['detection_model'],
             'detection_confidence': camera_state['detection_confidence'],
             'detections_count': len(camera_state['detections']),
+            'frame_seq': frame_seq,
+            'viewers': camera_state['viewers'],
+            'capturing': camera_state['capturing'],
+            'detection_queue_depth': len(detection_queue),
+            'detection_dropped': camera_state['detection_dropped'],
+            'capture_dropped': capture_buffers.dropped,
             'yolo_available': YOLO_AVAILABLE,
             'rfdetr_available': RFDETR_AVAILABLE,
         })
@@ -243,7 +845,9 @@ def set_brightness():
     data = request.get_json()
     value = int(data.get('value', 0))
     value = max(-50, min(50, value))  # Clamp to -50..50
-    camera_state['brightness'] = value
+    with camera_state['lock']:
+        camera_state['brightness'] = value
+        update_adjuster()
     return jsonify({'brightness': camera_state['brightness']})
 
 @app.route('/api/contrast', methods=['POST'])
@@ -252,16 +856,37 @@ def set_contrast():
     data = request.get_json()
     value = float(data.get('value', 1.0))
     value = max(0.5, min(2.0, value))  # Clamp to 0.5..2.0
-    camera_state['contrast'] = value
+    with camera_state['lock']:
+        camera_state['contrast'] = value
+        update_adjuster()
     return jsonify({'contrast': camera_state['contrast']})
 
 @app.route('/api/night_mode', methods=['POST'])
 def toggle_night_mode():
     """Toggle night mode"""
     data = request.get_json()
-    camera_state['night_mode'] = data.get('enabled', False)
+    with camera_state['lock']:
+        camera_state['night_mode'] = data.get('enabled', False)
+        update_adjuster()
     return jsonify({'night_mode': camera_state['night_mode']})
 
+def scan_next_frame_index(output_dir):
+    """Find the capture number following the highest existing frame_NNNN.jpg"""
+    indices = (int(p.stem[len('frame_'):]) for p in output_dir.glob('frame_*.jpg')
+               if p.stem[len('frame_'):].isdigit())
+    return 1 + max(indices, default=-1)
+
+def reserve_frame_index(output_dir):
+    """Return the next capture number for output_dir, scanning it only the first time"""
+    key = output_dir.resolve()
+    with camera_state['lock']:
+        next_idx = camera_state['next_frame_idx']
+        if key not in next_idx:
+            next_idx[key] = scan_next_frame_index(output_dir)
+        index = next_idx[key]
+        next_idx[key] += 1
+    return index
+
 @app.route('/api/capture', methods=['POST'])
 def capture_image():
     """Capture current frame to file"""
@@ -269,13 +894,10 @@ def capture_image():
     output_dir = Path(data.get('output_dir', './frames'))
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    with camera_state['lock']:
-        frame = camera_state['frame']
-    
+    frame = latest_frame()
     if frame:
-        # Find next filename
-        existing_files = list(output_dir.glob('frame_*.jpg'))
-        next_num = len(existing_files)
+        # Next filename comes from the cached counter, not a directory scan
+        next_num = reserve_frame_index(output_dir)
         filename = output_dir / f'frame_{next_num:04d}.jpg'
         
         with open(filename, 'wb') as f:
@@ -311,14 +933,58 @@ def set_detection_confidence():
     camera_state['detection_confidence'] = confidence
     return jsonify({'confidence': camera_state['detection_confidence']})
 
-if __name__ == '__main__':
+def start_background_tasks():
+    """Load models and start the camera capture and detection threads"""
     # Load detection models
     load_models()
+    warm_up_models()
+    
+    # Initialize the capture counter for the default output directory
+    frames_dir = Path('./frames')
+    camera_state['next_frame_idx'][frames_dir.resolve()] = scan_next_frame_index(frames_dir)
+    
+    # The native adjuster compiles in the background; LUT is used meanwhile
+    if ADJUST_BACKEND == 'native':
+        threading.Thread(target=prepare_native_adjuster, daemon=True).start()
     
     # Start camera capture thread
     camera_thread = threading.Thread(target=capture_frames, daemon=True)
     camera_thread.start()
     
-    # Start Flask server
-    print("Starting web server at http://0.0.0.0:5000")
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+    # Start batched detection worker
+    detection_thread = threading.Thread(target=detection_worker, daemon=True)
+    detection_thread.start()
+
+if GUNICORN_AVAILABLE:
+    class StreamServer(BaseApplication):
+        """Serve the Flask app from gunicorn's threaded worker"""
+        
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+        
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return self.application
+
+if __name__ == '__main__':
+    print(f"Starting web server at http://{SERVER_HOST}:{SERVER_PORT}")
+    if GUNICORN_AVAILABLE:
+        # A single worker process owns the camera and the models, and its
+        # threads serve the viewers. gunicorn forks that worker, so camera
+        # and CUDA setup must happen in post_worker_init, after the fork.
+        StreamServer(app, {
+            'bind': f'{SERVER_HOST}:{SERVER_PORT}',
+            'workers': 1,
+            'worker_class': 'gthread',
+            'threads': SERVER_THREADS,
+            'timeout': 120,  # model loading runs before the first heartbeat
+            'post_worker_init': lambda worker: start_background_tasks(),
+        }).run()
+    else:
+        start_background_tasks()
+        app.run(host=SERVER_HOST, port=SERVER_PORT, debug=False, threaded=True)